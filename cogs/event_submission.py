@@ -6,16 +6,18 @@ Supports the following discord commands
 * /event spreadsheet
 """
 
+import asyncio
+import threading
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Type
 
 from pydantic import BaseModel, AnyHttpUrl
 import pydantic
 import discord
+import gspread
 from discord.ext import commands
-from table2ascii import table2ascii, PresetStyle
 
-from helpers.pydantic_helpers import validate_datetime, validate_time, optional_wrapper
+from helpers.pydantic_helpers import validate_datetime, validate_time, optional_wrapper, time_to_seconds
 import helpers.gspread_helpers as gh
 from helpers.enums import WSEnum
 from gc_context import gc
@@ -34,18 +36,40 @@ class DEvent(WSEnum):
 
 
 class FEventSubmissions(WSEnum):
-    user_name = 0
-    submission_datetime = 1
-    event_name = 2
-    time = 3
-    video_link = 4
-    powerstage_time = 5
+    user_id = 0
+    user_name = 1
+    submission_datetime = 2
+    event_name = 3
+    time = 4
+    video_link = 5
+    powerstage_time = 6
+
+
+# Header of the /event standings table. The user id is only used as a key and is not shown
+STANDINGS_HEADER = ["rank", *FEventSubmissions.headers_tuple()[FEventSubmissions.user_name.value:]]
+
+
+def _submission_time_key(row: List[str]) -> float:
+    """Sort key for submission rows by time. The sheet can be edited by hand, so rows with a time that can not be
+    parsed are sorted last instead of failing the sort
+
+    Args:
+        row: A row of the FEventSubmissions worksheet
+
+    Returns:
+        The time of the submission in seconds, or infinity if it can not be parsed
+    """
+    try:
+        return time_to_seconds(row[FEventSubmissions.time.value])
+    except ValueError:
+        return float("inf")
 
 
 class EventSubmissionModel(BaseModel):
     """
     Pydantic data model for an event submission
     """
+    user_id: str  # Discord ids are stored as text since they exceed the integer precision of google sheets
     user_name: str
     submission_datetime: datetime
     event_name: str
@@ -71,6 +95,45 @@ class EventCommands(commands.Cog):
         """
         self.bot = bot
         self.sh = gh.get_or_create_spreadsheet(gc, EVENT_SH_NAME, EVENT_SH_WRITERS)
+        self._worksheets: Dict[Type[WSEnum], gspread.worksheet.Worksheet] = {}
+        self._worksheets_lock = threading.Lock()
+        self._write_lock = asyncio.Lock()
+
+        # Create and migrate the worksheets before the bot starts handling commands
+        self._ws(DEvent)
+        self._ws(FEventSubmissions)
+
+    def _ws(self, ws_enum: Type[WSEnum]) -> gspread.worksheet.Worksheet:
+        """Gets the worksheet described by a WSEnum, creating it or adding missing columns if needed.
+        The worksheet is cached on first use. This may be called from several threads, so worksheets are only
+        created and migrated by one of them at a time
+
+        Args:
+            ws_enum: A WSEnum describing the title and headers of the worksheet
+
+        Returns:
+            A worksheet with the title of the enum
+        """
+        with self._worksheets_lock:
+            if ws_enum not in self._worksheets:
+                ws = gh.get_or_create_worksheet(self.sh, ws_enum.title(), ws_enum.headers())
+                # Add columns introduced after the worksheet was created, so rows can be read by enum position
+                gh.ensure_headers(ws, ws_enum.headers())
+                self._worksheets[ws_enum] = ws
+            return self._worksheets[ws_enum]
+
+    def _reset_sheet_caches(self, error: Exception):
+        """Drops all cached sheet state after a Sheets API error, so the next command looks the worksheets up again.
+        This recovers from e.g. a worksheet being deleted or renamed in the spreadsheet
+
+        Args:
+            error: An exception
+        """
+        if isinstance(getattr(error, "original", error), gspread.exceptions.GSpreadException):
+            # Not taking _worksheets_lock, since waiting on a thread that is creating a worksheet would block the
+            # event loop. Clearing a dict is atomic
+            self._worksheets.clear()
+            gh.clear_cache()
 
     @event_cmd_group.command()
     async def spreadsheet(self, ctx: discord.ApplicationContext):
@@ -95,18 +158,21 @@ class EventCommands(commands.Cog):
             event_name: The name of the event
             has_powerstage: A bool indicating if there's a powerstage in the event or not
         """
+        await ctx.defer(ephemeral=True)
         # Add event worksheet if not exist
-        ws = gh.get_or_create_worksheet(self.sh, DEvent.title(), DEvent.headers())
+        ws = await asyncio.to_thread(self._ws, DEvent)
 
         row_entry = [event_name, has_powerstage]
 
-        # if the entry is already in the worksheet, don't add it
-        if row_entry[0] in gh.get_values_by_header(ws, DEvent.event_name.name):
-            await ctx.send_response(f"Event '{event_name}' already exists", ephemeral=True)
-            return
+        # Hold the write lock from the duplicate check until the row is written, so concurrent adds can not both pass
+        async with self._write_lock:
+            # if the entry is already in the worksheet, don't add it
+            if await asyncio.to_thread(gh.header_has_value, ws, DEvent.event_name.name, event_name):
+                await ctx.followup.send(f"Event '{event_name}' already exists", ephemeral=True)
+                return
 
-        gh.safe_append_row(ws, row_entry)
-        await ctx.send_response(
+            await asyncio.to_thread(gh.safe_append_row, ws, row_entry, raw=True)
+        await ctx.followup.send(
             f"Added '{event_name}' as an event {'with' if has_powerstage else 'without'} powerstage",
             ephemeral=True
         )
@@ -133,6 +199,7 @@ class EventCommands(commands.Cog):
         await ctx.defer(ephemeral=True)
         # Validate data
         event_submission = EventSubmissionModel(
+            user_id=str(ctx.user.id),
             user_name=ctx.user.name,
             submission_datetime=datetime.now(),
             event_name=event_name,
@@ -141,51 +208,62 @@ class EventCommands(commands.Cog):
             powerstage_time=powerstage_time
         )
 
+        submission_dict = event_submission.dict()
         row_entry = [
-            dict(event_submission)[header] for header in FEventSubmissions.headers()
+            submission_dict[header] for header in FEventSubmissions.headers_tuple()
         ]  # Create entry with correct order
-        f_event_sub_ws = gh.get_or_create_worksheet(self.sh, FEventSubmissions.title(),
-                                                    FEventSubmissions.headers())
-
-        # If the event is not in the event dimension table, reject and inform the user
-        d_event_ws = gh.get_or_create_worksheet(self.sh, DEvent.title(), DEvent.headers())
-        if event_submission.event_name not in (events := gh.get_values_by_header(d_event_ws, DEvent.event_name.name)):
-            await ctx.followup.send(
-                f"Submission rejected :x: Event {event_name} has not been registered. These events are available: {events}",
-                ephemeral=True
-            )
-            return
-
-        # If the exact entry already exists in the event submission fact table, reject and inform the user
-        if gh.get_first_row_where_header(f_event_sub_ws, FEventSubmissions.video_link.name,
-                                         event_submission.video_link):
-            await ctx.followup.send(
-                f"Submission rejected :x: Video link {video_link} has already been submitted.",
-                ephemeral=True
-            )
-            return
-
-        # If the event has a powerstage and the powerstage time was not entered, reject.
-        event_row = gh.get_first_row_where_header(d_event_ws, DEvent.event_name.name, event_submission.event_name)
-        event_has_powerstage = gh.str2bool(event_row[DEvent.has_powerstage.value])
-        if event_has_powerstage and not powerstage_time:
-            await ctx.followup.send(
-                f"Submission rejected :x: Event {event_name} requires powerstage_time to be entered",
-                ephemeral=True
-            )
-            return
-
-        # If event does not have a powerstage, but powerstage time was entered, reject
-        if not event_has_powerstage and powerstage_time:
-            await ctx.followup.send(
-                f"Submission rejected :x: Event {event_name} does not have a powerstage. Hence powerstage time "
-                f"should not be entered",
-                ephemeral=True
-            )
-            return
-
-        # Add event submission to the event submission fact table
-        gh.safe_append_row(f_event_sub_ws, row_entry)
+        # Run all Sheets I/O in a thread so the event loop stays responsive
+        f_event_sub_ws = await asyncio.to_thread(self._ws, FEventSubmissions)
+        await asyncio.to_thread(self._ws, DEvent)  # Both worksheets must exist to be read
+
+        # Hold the write lock from the duplicate checks until the row is written, so concurrent submits of the
+        # same video link can not both pass
+        async with self._write_lock:
+            # Read both worksheets in one call and do all lookups in memory
+            batch = await asyncio.to_thread(gh.batch_get_worksheets, self.sh,
+                                            [(DEvent.title(), None), (FEventSubmissions.title(), None)])
+            d_event_rows = batch[DEvent.title()][1:]
+            f_event_sub_rows = batch[FEventSubmissions.title()][1:]
+
+            # If the event is not in the event dimension table, reject and inform the user
+            events = [row[DEvent.event_name.value] for row in d_event_rows]
+            if event_submission.event_name not in events:
+                await ctx.followup.send(
+                    f"Submission rejected :x: Event {event_name} has not been registered. "
+                    f"These events are available: {events}",
+                    ephemeral=True
+                )
+                return
+
+            # If the exact entry already exists in the event submission fact table, reject and inform the user
+            if any(row[FEventSubmissions.video_link.value] == event_submission.video_link for row in f_event_sub_rows):
+                await ctx.followup.send(
+                    f"Submission rejected :x: Video link {video_link} has already been submitted.",
+                    ephemeral=True
+                )
+                return
+
+            # If the event has a powerstage and the powerstage time was not entered, reject.
+            event_row = d_event_rows[events.index(event_submission.event_name)]
+            event_has_powerstage = gh.str2bool(event_row[DEvent.has_powerstage.value])
+            if event_has_powerstage and not powerstage_time:
+                await ctx.followup.send(
+                    f"Submission rejected :x: Event {event_name} requires powerstage_time to be entered",
+                    ephemeral=True
+                )
+                return
+
+            # If event does not have a powerstage, but powerstage time was entered, reject
+            if not event_has_powerstage and powerstage_time:
+                await ctx.followup.send(
+                    f"Submission rejected :x: Event {event_name} does not have a powerstage. Hence powerstage time "
+                    f"should not be entered",
+                    ephemeral=True
+                )
+                return
+
+            # Add event submission to the event submission fact table
+            await asyncio.to_thread(gh.safe_append_row, f_event_sub_ws, row_entry, raw=True)
 
         await ctx.followup.send(
             f"Submission accepted :white_check_mark: Event was submitted successfully",
@@ -204,35 +282,42 @@ class EventCommands(commands.Cog):
             event_name: A name of an event
             public: If the results of the call should be shared publicly or not
         """
+        # Only needed by this command, so imported here to keep it off the bot startup path
+        from table2ascii import table2ascii, PresetStyle
+
         await ctx.defer(ephemeral=not public)
-        f_event_sub_ws = gh.get_or_create_worksheet(self.sh, FEventSubmissions.title(),
-                                                    FEventSubmissions.headers())
+        f_event_sub_ws = await asyncio.to_thread(self._ws, FEventSubmissions)
 
         # Get all times for specified event
-        event_subs = gh.get_rows_where_header(f_event_sub_ws, FEventSubmissions.event_name.name, event_name)
+        event_subs = await asyncio.to_thread(gh.get_rows_where_header, f_event_sub_ws,
+                                             FEventSubmissions.event_name.name, event_name)
 
         # if the event has no submissions return
-        if not any(event_name in event_sub for event_sub in event_subs):
+        if not event_subs:
             await ctx.followup.send(f"Event '{event_name}' has no submissions", ephemeral=True)
             return
 
         # Sort times from lowest to highest
-        sorted_subs = sorted(event_subs, key=lambda x: x[FEventSubmissions.time.value])
-
-        # Filter out top time per user
-        filtered_subs = []
-        processed_users = set()
+        sorted_subs = sorted(event_subs, key=_submission_time_key)
+
+        # Filter out top time per user. Dicts keep insertion order, so the first (fastest) row per user is kept
+        # Submissions from before user ids were stored only have a user name. Map those names to the id found on
+        # newer rows of the same user, so a user with both old and new submissions is only listed once
+        name_to_id = {
+            row[FEventSubmissions.user_name.value]: row[FEventSubmissions.user_id.value]
+            for row in event_subs if row[FEventSubmissions.user_id.value]
+        }
+        top_subs = {}
         for row in sorted_subs:
-            user = row[FEventSubmissions.user_name.value]
-            if user in processed_users:
-                continue
-            processed_users.add(user)
-            filtered_subs.append(row)
-
-        # Format table
-        ranked_subs = [[i + 1] + x for i, x in enumerate(filtered_subs)]
+            user_name = row[FEventSubmissions.user_name.value]
+            user = row[FEventSubmissions.user_id.value] or name_to_id.get(user_name, user_name)
+            top_subs.setdefault(user, row)
+        filtered_subs = list(top_subs.values())
+
+        # Format table. The rows come from the worksheet cache, so they are copied rather than mutated
+        ranked_subs = [[i, *x[FEventSubmissions.user_name.value:]] for i, x in enumerate(filtered_subs, start=1)]
         table = table2ascii(
-            header=["rank"] + FEventSubmissions.headers(),
+            header=STANDINGS_HEADER,
             body=ranked_subs,
             style=PresetStyle.thin_compact
         )
@@ -260,7 +345,9 @@ class EventCommands(commands.Cog):
             ctx: A discord ApplicationContext
             error: An exception
         """
-        await ctx.send_response(f":warning: Unexpected error when calling /event add: {str(error)}", ephemeral=True)
+        self._reset_sheet_caches(error)
+        # Role checks fail before the command defers, so respond to or follow up the interaction as needed
+        await ctx.respond(f":warning: Unexpected error when calling /event add: {str(error)}", ephemeral=True)
 
     @submit.error
     async def submit_error(self, ctx: discord.ApplicationContext, error: Exception):
@@ -270,6 +357,7 @@ class EventCommands(commands.Cog):
             ctx: A discord ApplicationContext
             error: An exception
         """
+        self._reset_sheet_caches(error)
         await ctx.followup.send(f":warning: Unexpected error when calling /event submit: {str(error)}", ephemeral=True)
 
     @standings.error
@@ -280,6 +368,7 @@ class EventCommands(commands.Cog):
             ctx: A discord ApplicationContext
             error: An exception
         """
+        self._reset_sheet_caches(error)
         await ctx.followup.send(f":warning: Unexpected error when calling /event standings: {str(error)}",
                                 ephemeral=True)
 
@@ -7,4 +7,23 @@ See https://docs.gspread.org/en/latest/oauth2.html
 import gspread
 from pathlib import Path
 
-gc = gspread.service_account(str(Path(__file__).parent / '.service_account.json'))
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+creds = Credentials.from_service_account_file(str(Path(__file__).parent / '.service_account.json'),
+                                              scopes=gspread.auth.DEFAULT_SCOPES)
+
+# Reuse one pooled connection for all Sheets/Drive calls, and retry failed connections.
+# Error status codes are not retried here, gspread_helpers.with_backoff handles those.
+session = AuthorizedSession(creds)
+adapter = HTTPAdapter(pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=None))
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+gc = gspread.Client(auth=creds, session=session)
+
+# Fetch the access token at import time so the first command does not wait for the OAuth token exchange.
+# The session refreshes it when it expires.
+gc.login()
@@ -3,5 +3,5 @@ from pathlib import Path
 
 def get_token_from_file(file: Path) -> str:
     """ Naively parse a file for a token. Expects the format to be <TOKEN_NAME>=<TOKEN>."""
-    with file.open() as f:
-        return f.read().split('=')[1]
+    _, _, token = file.read_text().partition('=')
+    return token.strip()
@@ -1,10 +1,16 @@
+import functools
 from enum import Enum, EnumMeta
 
 
 class WSEnum(Enum):
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def headers_tuple(cls: EnumMeta):
+        return tuple(x.name for x in cls)
+
     @classmethod
     def headers(cls: EnumMeta):
-        return [x.name for x in cls]
+        return list(cls.headers_tuple())
 
     @classmethod
     def title(cls: EnumMeta):
@@ -1,7 +1,62 @@
-from typing import List, Any
+import functools
+import json
+import random
+import re
+import time
+from typing import List, Any, Callable, Collection, Dict, Iterator, Optional, Tuple
 
 import gspread
 
+# Endpoint for sending several Drive API requests in one HTTP request
+DRIVE_BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+_BATCH_BOUNDARY = "cat_bot_batch"
+
+# Status codes of transient Sheets/Drive API errors that are retried, and the retry limits
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 6
+MAX_BACKOFF_SECONDS = 64
+
+# Seconds a worksheet read is served from memory before it is fetched again. Set to 0 to disable caching.
+TTL_SECONDS = 30
+
+# Cache of all worksheet values, keyed by (spreadsheet id, worksheet id, method)
+_values_cache: Dict[Tuple[str, int, str], Tuple[float, List[List[Any]]]] = {}
+
+# Cache of header rows, keyed by (spreadsheet id, worksheet id). Headers do not change while the bot is running
+_header_cache: Dict[Tuple[str, int], List[str]] = {}
+
+# Cache of spreadsheets, keyed by name
+_spreadsheet_cache: Dict[str, gspread.spreadsheet.Spreadsheet] = {}
+
+# Cache of worksheets by title, keyed by spreadsheet id
+_worksheets_cache: Dict[str, Dict[str, gspread.worksheet.Worksheet]] = {}
+
+
+def with_backoff(status_codes: Collection[int] = RETRY_STATUS_CODES) -> Callable:
+    """Retries a function with exponential backoff when a gspread call fails with a transient API error
+
+    Args:
+        status_codes: HTTP status codes of the errors to retry
+
+    Returns:
+        A decorator
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def _with_backoff(*args, **kwargs):
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    return func(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    if attempt == MAX_RETRIES or e.response.status_code not in status_codes:
+                        raise
+                    time.sleep(min(2 ** attempt + random.random(), MAX_BACKOFF_SECONDS))
+
+        return _with_backoff
+
+    return decorator
+
 
 def str2bool(s: str) -> bool:
     if s.lower() == "true":
@@ -12,17 +67,48 @@ def str2bool(s: str) -> bool:
         raise ValueError(f"Could not convert {s} to boolean")
 
 
-def spreadsheet_exists(gc: gspread.client.Client, sheet_name: str) -> bool:
-    """Check if a spreadsheet exists
+@with_backoff()
+def _list_worksheets(sh: gspread.spreadsheet.Spreadsheet) -> List[gspread.worksheet.Worksheet]:
+    """Lists the worksheets of a spreadsheet, retrying transient errors
+
+    Args:
+        sh: A gspread Spreadsheet
+
+    Returns:
+        A list of worksheets
+    """
+    return sh.worksheets()
+
+
+@with_backoff()
+def _open_spreadsheet(gc: gspread.client.Client, sh_name: str) -> gspread.spreadsheet.Spreadsheet:
+    """Opens a spreadsheet by name, retrying transient errors
 
     Args:
         gc: A gspread Client
-        sheet_name: The name of the sheet
+        sh_name: Name of spreadsheet
 
     Returns:
-        True if it exists, False otherwise
+        The spreadsheet with the requested name
+
+    Raises:
+        gspread.exceptions.SpreadsheetNotFound: If no spreadsheet has the name
+    """
+    return gc.open(sh_name)
+
+
+def _cached_worksheets(sh: gspread.spreadsheet.Spreadsheet) -> Dict[str, gspread.worksheet.Worksheet]:
+    """Gets the worksheets of a spreadsheet by title. The worksheets are only listed on first use
+
+    Args:
+        sh: A gspread Spreadsheet
+
+    Returns:
+        A dict mapping worksheet titles to worksheets
     """
-    return sheet_name in [sh["name"] for sh in gc.list_spreadsheet_files()]
+    if sh.id not in _worksheets_cache:
+        _worksheets_cache[sh.id] = {ws.title: ws for ws in _list_worksheets(sh)}
+    return _worksheets_cache[sh.id]
 
 
 def worksheet_exists(sh: gspread.spreadsheet.Spreadsheet, worksheet_title: str) -> bool:
@@ -35,7 +121,44 @@ def worksheet_exists(sh: gspread.spreadsheet.Spreadsheet, worksheet_title: str)
     Returns:
         True if it exists, False otherwise
     """
-    return worksheet_title in [ws.title for ws in sh.worksheets()]
+    return worksheet_title in _cached_worksheets(sh)
+
+
+def share_with_writers(sh: gspread.spreadsheet.Spreadsheet, writers: List[str]):
+    """Gives all writers write permission to a spreadsheet with a single Drive batch request
+
+    Args:
+        sh: A gspread Spreadsheet
+        writers: A list of emails who will have writing permissions
+
+    Raises:
+        gspread.exceptions.GSpreadException: If any of the permissions could not be created
+    """
+    if not writers:
+        return
+
+    parts = []
+    for i, writer in enumerate(writers):
+        permission = {"type": "user", "role": "writer", "emailAddress": writer}
+        parts.append(
+            f"--{_BATCH_BOUNDARY}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <{i}>\r\n\r\n"
+            f"POST /drive/v3/files/{sh.id}/permissions?supportsAllDrives=true HTTP/1.1\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{json.dumps(permission)}\r\n"
+        )
+    body = "".join(parts) + f"--{_BATCH_BOUNDARY}--"
+
+    response = sh.client.request(
+        "post", DRIVE_BATCH_URL, data=body,
+        headers={"Content-Type": f"multipart/mixed; boundary={_BATCH_BOUNDARY}"}
+    )
+
+    # The batch itself succeeds even if parts of it fail, so check the status of every part
+    statuses = [int(status) for status in re.findall(r"^HTTP/1\.1 (\d{3})", response.text, re.MULTILINE)]
+    if len(statuses) != len(writers) or any(status >= 300 for status in statuses):
+        raise gspread.exceptions.GSpreadException(f"Could not share spreadsheet with all writers: {response.text}")
 
 
 def get_or_create_spreadsheet(gc: gspread.client.Client, sh_name: str,
@@ -50,19 +173,27 @@ def get_or_create_spreadsheet(gc: gspread.client.Client, sh_name: str,
     Returns:
         A spreadsheet with the requested name
     """
+    # If the spreadsheet has already been looked up by this process, return it
+    if sh_name in _spreadsheet_cache:
+        return _spreadsheet_cache[sh_name]
+
     # If the spreadsheet exists, return it
-    if spreadsheet_exists(gc, sh_name):
-        return gc.open(sh_name)
+    try:
+        sh = _spreadsheet_cache[sh_name] = _open_spreadsheet(gc, sh_name)
+        return sh
+    except gspread.exceptions.SpreadsheetNotFound:
+        pass
 
-    # Create the spreadsheet and give all writers write permission
+    # Create the spreadsheet and give all writers write permission. Creating is not retried since a failed
+    # request might still have created the spreadsheet
     sh = gc.create(sh_name)
-    for writer in writers:
-        sh.share(writer, perm_type="user", role="writer")
+    share_with_writers(sh, writers)
     ws = sh.get_worksheet(0)
 
     # Rename the first slide to Playground. This slide should be used by users to do adhoc analysis, readme's etc.
     ws.update_title("Playground")
 
+    _spreadsheet_cache[sh_name] = sh
     return sh
 
 
@@ -80,17 +211,63 @@ def get_or_create_worksheet(sh: gspread.spreadsheet.Spreadsheet, ws_title: str,
     """
     # If the worksheet exists, return it
     if worksheet_exists(sh, ws_title):
-        return sh.worksheet(ws_title)
+        return _cached_worksheets(sh)[ws_title]
 
     # Create the worksheet with the provided headers
     ws = sh.add_worksheet(ws_title, 1, len(headers))
+    _cached_worksheets(sh)[ws_title] = ws
 
     # Add headers
     ws.append_row(headers)
+    _header_cache[(sh.id, ws.id)] = list(headers)
 
     return ws
 
 
+def clear_cache():
+    """Clears all cached spreadsheets, worksheets, worksheet values and headers"""
+    _spreadsheet_cache.clear()
+    _values_cache.clear()
+    _header_cache.clear()
+    _worksheets_cache.clear()
+
+
+def _cache_key(ws: gspread.worksheet.Worksheet) -> Tuple[str, int, str]:
+    return ws.spreadsheet.id, ws.id, "all_values"
+
+
+def _invalidate_cache(ws: gspread.worksheet.Worksheet):
+    """Drops the cached values of a worksheet so that the next read fetches them again
+
+    Args:
+        ws: A gspread Worksheet
+    """
+    _values_cache.pop(_cache_key(ws), None)
+
+
+@with_backoff()
+def _get_all_values_cached(ws: gspread.worksheet.Worksheet) -> List[List[Any]]:
+    """Gets all values of the worksheet, including headers, with a single read.
+
+    The values are kept in memory for TTL_SECONDS, so repeated reads are served without calling the Sheets API.
+
+    Args:
+        ws: A gspread Worksheet
+
+    Returns:
+        A list of list with all worksheet entries
+    """
+    key = _cache_key(ws)
+    cached = _values_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < TTL_SECONDS:
+        return cached[1]
+
+    all_values = ws.get_values()
+    if TTL_SECONDS > 0:
+        _values_cache[key] = (time.monotonic(), all_values)
+    return all_values
+
+
 def get_header(ws: gspread.worksheet.Worksheet) -> List[str]:
     """Gets the first row of the worksheet
 
@@ -100,26 +277,90 @@ def get_header(ws: gspread.worksheet.Worksheet) -> List[str]:
     Returns:
         A list of headers
     """
-    return ws.row_values(1)
+    key = (ws.spreadsheet.id, ws.id)
+    if key not in _header_cache:
+        all_values = _get_all_values_cached(ws)
+        if not all_values:
+            return []
+        _header_cache[key] = list(all_values[0])
+    return list(_header_cache[key])
 
 
-def safe_append_row(ws: gspread.worksheet.Worksheet, row: List[Any]):
-    """Appends rows to a worksheet if the number of elements in the row is equal to the number of headers
+def ensure_headers(ws: gspread.worksheet.Worksheet, headers: List[str]):
+    """Adds the headers missing from a worksheet as new columns, so that the header row matches headers
 
     Args:
         ws: A gspread Worksheet
-        row: A list of elements to add to the sheet
+        headers: A list of headers for the worksheet
+
+    Raises:
+        ValueError: If the existing headers are not a subset of headers in the same order
+    """
+    current = get_header(ws)
+    if current == headers:
+        return
+
+    if [header for header in headers if header in current] != current:
+        raise ValueError(f"Worksheet {ws.title} has headers {current} which can not be migrated to {headers}")
+
+    # Insert each missing column at its position. Existing rows get an empty value in the new column
+    for col_idx, header in enumerate(headers, start=1):
+        if header not in current:
+            ws.insert_cols([[header]], col_idx)
+
+    _header_cache[(ws.spreadsheet.id, ws.id)] = list(headers)
+    _invalidate_cache(ws)
+
+
+@with_backoff(status_codes={429})  # Only retry rejected writes, a failed write might still have been applied
+def _append_rows(ws: gspread.worksheet.Worksheet, rows: List[List[Any]], value_input_option: str):
+    """Appends rows to a worksheet, retrying rate limited requests
+
+    Args:
+        ws: A gspread Worksheet
+        rows: A list of rows, each a list of elements to add to the sheet
+        value_input_option: A gspread ValueInputOption
+    """
+    ws.append_rows(rows, value_input_option=value_input_option)
+
+
+def safe_append_rows(ws: gspread.worksheet.Worksheet, rows: List[List[Any]], *, raw: bool = False):
+    """Appends rows to a worksheet in a single call if the number of elements in every row is equal to the number
+    of headers
+
+    Args:
+        ws: A gspread Worksheet
+        rows: A list of rows, each a list of elements to add to the sheet
+        raw: If True the values are stored as is. Otherwise they are parsed as if typed by a user, which allows
+            google sheets to format them but also evaluates e.g. values starting with '=' as formulas
 
     Raises:
         ValueError
     """
-    # Validate that the number of elements in the row matches the header count
+    # Validate that the number of elements in each row matches the header count
     headers = get_header(ws)
-    if len(headers) != len(row):
+    if any(len(headers) != len(row) for row in rows):
         raise ValueError("Row can require more columns than already exists in the worksheet")
 
-    # Append row as user input to allow for formatting by google sheets
-    ws.append_row(row, value_input_option=gspread.worksheet.ValueInputOption.user_entered)
+    # Append rows as user input to allow for formatting by google sheets, unless raw values are requested
+    value_input_option = (gspread.worksheet.ValueInputOption.raw if raw
+                          else gspread.worksheet.ValueInputOption.user_entered)
+    _append_rows(ws, rows, value_input_option)
+    _invalidate_cache(ws)
+
+
+def safe_append_row(ws: gspread.worksheet.Worksheet, row: List[Any], *, raw: bool = False):
+    """Appends a row to a worksheet if the number of elements in the row is equal to the number of headers
+
+    Args:
+        ws: A gspread Worksheet
+        row: A list of elements to add to the sheet
+        raw: If True the values are stored as is, see safe_append_rows
+
+    Raises:
+        ValueError
+    """
+    safe_append_rows(ws, [row], raw=raw)
 
 
 def get_values_by_header(ws: gspread.worksheet.Worksheet, header: str) -> List[Any]:
@@ -137,11 +378,11 @@ def get_values_by_header(ws: gspread.worksheet.Worksheet, header: str) -> List[A
     """
     headers = get_header(ws)
     try:
-        col_idx = headers.index(header) + 1  # Worksheets are 1-indexed
+        col_idx = headers.index(header)
     except ValueError:
         raise ValueError("Header is not present in worksheet")
 
-    return ws.col_values(col_idx)[1:]
+    return [row[col_idx] if col_idx < len(row) else "" for row in get_values(ws)]
 
 
 def get_values(ws: gspread.worksheet.Worksheet) -> List[List[Any]]:
@@ -153,7 +394,56 @@ def get_values(ws: gspread.worksheet.Worksheet) -> List[List[Any]]:
     Returns:
         A list of list with worksheet entries
     """
-    return ws.get_values()[1:]
+    return _get_all_values_cached(ws)[1:]
+
+
+@with_backoff()
+def batch_get_worksheets(sh: gspread.spreadsheet.Spreadsheet,
+                         ranges: List[Tuple[str, Optional[str]]]) -> Dict[str, List[List[Any]]]:
+    """Gets values from several worksheets with a single Sheets API call
+
+    Args:
+        sh: A gspread Spreadsheet
+        ranges: A list of (worksheet title, A1 range) tuples. If the range is None the whole worksheet is fetched
+
+    Returns:
+        A dict mapping each worksheet title to a list of list with its entries, including headers
+    """
+    range_names = [gspread.utils.absolute_range_name(title, a1_range) for title, a1_range in ranges]
+    response = sh.values_batch_get(range_names)
+
+    # Value ranges are returned in the same order as requested
+    return {
+        title: gspread.utils.fill_gaps(value_range.get("values", []))
+        for (title, _), value_range in zip(ranges, response["valueRanges"])
+    }
+
+
+def _iter_rows_where_header(ws: gspread.worksheet.Worksheet, header: str, value: Any) -> Iterator[list]:
+    """Yields rows where header has value, using a single read of the worksheet
+
+    Args:
+        ws: A gspread Worksheet
+        header: Name of the header
+        value: Value to look for in header column
+
+    Returns:
+        An iterator over matching worksheet entries
+
+    Raises:
+        ValueError: If the header can not be found in the worksheet
+    """
+    all_values = _get_all_values_cached(ws)
+    if not all_values:
+        raise ValueError("Header is not present in worksheet")
+
+    headers, *rows = all_values
+    try:
+        col_idx = headers.index(header)
+    except ValueError:
+        raise ValueError("Header is not present in worksheet")
+
+    return (row for row in rows if col_idx < len(row) and row[col_idx] == value)
 
 
 def get_first_row_where_header(ws: gspread.worksheet.Worksheet, header: str, value: Any) -> list:
@@ -168,12 +458,28 @@ def get_first_row_where_header(ws: gspread.worksheet.Worksheet, header: str, val
         A list with matching worksheet entries
     """
     try:
-        ind = get_values_by_header(ws, header).index(value)
-        return get_values(ws)[ind]
+        return next(_iter_rows_where_header(ws, header, value), [])
     except ValueError:
         return []
 
 
+def header_has_value(ws: gspread.worksheet.Worksheet, header: str, value: Any) -> bool:
+    """Check if any row has value under header
+
+    Args:
+        ws: A gspread Worksheet
+        header: Name of the header
+        value: Value to look for in header column
+
+    Returns:
+        True if the value exists, False otherwise
+
+    Raises:
+        ValueError: If the header can not be found in the worksheet
+    """
+    return next(_iter_rows_where_header(ws, header, str(value)), None) is not None
+
+
 def get_rows_where_header(ws: gspread.worksheet.Worksheet, header: str, value: Any) -> List[list]:
     """Returns all rows for where header has value
 
@@ -186,12 +492,6 @@ def get_rows_where_header(ws: gspread.worksheet.Worksheet, header: str, value: A
         A list of list with matching worksheet entries
     """
     try:
-        indices = [ind for ind, x in enumerate(get_values_by_header(ws, header)) if x == value]
-        vals = []
-        all_vals = get_values(ws)
-        for ind in indices:
-            vals.append(all_vals[ind])
-
-        return vals
+        return list(_iter_rows_where_header(ws, header, value))
     except ValueError:
-        return [[]]
+        return []
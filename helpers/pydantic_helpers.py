@@ -1,7 +1,12 @@
 import datetime
+import re
 from typing import Callable, Any
 
-from pydantic.datetime_parse import parse_duration, parse_datetime
+# Matches HH+:MM:SS.ffff where the hours are optional
+_TIME_RE = re.compile(r"(?:(\d+):)?([0-5]?\d):([0-5]\d)\.(\d{1,6})")
+
+# Kept as a module level name since validate_datetime's argument shadows the datetime module
+_fromisoformat = datetime.datetime.fromisoformat
 
 
 def optional_wrapper(func: Callable) -> Callable:
@@ -23,19 +28,37 @@ def optional_wrapper(func: Callable) -> Callable:
 
 
 def validate_time(time: str) -> str:
-    """Parses time to timedelta and converts to HH+:MM:SS.ffff
+    """Validates time and converts to HH+:MM:SS.ffff
 
     Args:
         time: A string on the format HH+:MM:SS.ffff
 
     Returns:
         A string on the format HH+:MM:SS.ffff
+
+    Raises:
+        ValueError: If the time is not on the format HH+:MM:SS.ffff
+    """
+    match = _TIME_RE.fullmatch(time)
+    if not match:
+        raise ValueError(f"Time {time} is not on the format [H:]MM:SS.ff")
+
+    hours, minutes, seconds, fraction = match.groups()
+    microseconds = int(fraction.ljust(6, "0"))
+    return f"{int(hours or 0)}:{int(minutes):02d}:{int(seconds):02d}.{microseconds:06d}"
+
+
+def time_to_seconds(time: str) -> float:
+    """Converts a time on the format [H:]MM:SS.ffff to seconds, e.g. for sorting times numerically
+
+    Args:
+        time: A string on the format [H:]MM:SS.ffff
+
+    Returns:
+        The total number of seconds
     """
-    duration = parse_duration(time)
-    days_in_hours = duration.days * 24
-    minutes, seconds = divmod(duration.seconds, 60)
-    hours, minutes = divmod(minutes, 60)
-    return f"{days_in_hours + hours}:{minutes}:{seconds}.{duration.microseconds}"
+    *hours, minutes, seconds = time.split(":")
+    return int(hours[0] if hours else 0) * 3600 + int(minutes) * 60 + float(seconds)
 
 
 def validate_datetime(datetime: datetime.datetime) -> str:
@@ -47,4 +70,6 @@ def validate_datetime(datetime: datetime.datetime) -> str:
     Returns:
         A string of the datetime object
     """
-    return str(parse_datetime(datetime))
+    if isinstance(datetime, str):
+        return str(_fromisoformat(datetime))
+    return str(datetime)
@@ -6,12 +6,14 @@ from pathlib import Path
 import discord
 from helpers.discord_helpers import get_token_from_file
 
-# Init discord bot
-# The token should be in the .env file on the form "DISCORD_TOKEN=<token>"
-# It should be retrieved from the discord developer page.
-bot = discord.Bot()
+# Only read if the TOKEN environment variable is not set
+ENV_PATH = Path(__file__).resolve().parent / '.env'
 
 if __name__ == '__main__':
+    # Init discord bot
+    # The token should be in the .env file on the form "DISCORD_TOKEN=<token>"
+    # It should be retrieved from the discord developer page.
+    bot = discord.Bot()
     bot.load_extension('cogs.event_submission')
     # TODO: Add a create event for admins?
-    bot.run(os.getenv('TOKEN') or get_token_from_file(Path(__file__).parent / '.env'))
+    bot.run(os.getenv('TOKEN') or get_token_from_file(ENV_PATH))